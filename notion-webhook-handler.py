@@ -1,17 +1,151 @@
+import asyncio
+import base64
+import hashlib
 import json
 import os
-import urllib.request
-import urllib.error
+import time
+import unicodedata
 
-from openai import OpenAI
+import httpx
+from openai import DEFAULT_CONNECTION_LIMITS, AsyncOpenAI, DefaultAsyncHttpxClient
+
+try:
+    import orjson  # 任意: Lambda レイヤーで配布する。無ければ標準 json にフォールバック
+except ImportError:
+    orjson = None
+
+
+def _json_loads(s: str | bytes):
+    # orjson.JSONDecodeError は json.JSONDecodeError のサブクラスなので except 側はそのままでよい
+    return orjson.loads(s) if orjson else json.loads(s)
+
+
+def _json_dumps(obj) -> bytes:
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode("utf-8")
+
+
+# アイドル接続を保持する秒数。httpx 既定の 5 秒だと OpenAI 呼び出し(5〜20秒)の間や
+# invocation 間の待ちで接続が捨てられるので、サーバ側の idle timeout より短い 60 秒に延ばす
+_KEEPALIVE_EXPIRY = 60.0
 
 # ---- OpenAI ----
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+client = AsyncOpenAI(
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+            max_keepalive_connections=DEFAULT_CONNECTION_LIMITS.max_keepalive_connections,
+            keepalive_expiry=_KEEPALIVE_EXPIRY,
+        ),
+    ),
+)
+MODEL = os.environ.get("OAI_MODEL", "gpt-5-nano")
+# 同時に投げる OpenAI リクエスト数の上限（RPM 制限対策）
+_oai_sem = asyncio.Semaphore(int(os.environ.get("OAI_CONCURRENCY", "5")))
+
+# overview/description/HQ を一括生成するプロンプト（{company_name}, {website} を埋める）
+_PROMPT_TMPL = """
+あなたは企業調査アナリストである。最新のWeb情報を検索して、次の企業の事業内容と本社所在地（HQ）を特定し要約せよ。
+
+- 企業名: {company_name}
+- Website: {website}
+
+### 調査情報源の指示（最重要）
+1. 一次情報としてのホームページ（URL）の情報を核とする。
+2. それに加え、客観的かつ広範な情報を収集するため、少なくとも５つ以上の信頼できる外部情報源
+   （TechCrunch, Bloomberg, Crunchbase, 公式プレスリリース等）を調査し、情報を統合する。
+3. 情報鮮度を重視し、直近3年以内の情報を優先して利用すること。
+4. 特に、技術的な特徴や市場での評価については、第三者による客観的な見解を優先して分析に含めること。
+
+### HQ（本社所在地）の指示（重要）
+- 複数のサイトを調査して本社所在地を特定せよ（一次情報＋第三者情報を照合すること）。
+- 本社所在地が一つに絞ることができない／情報が矛盾する／確証が持てない場合は「不明」と出力せよ。
+- HQの出力形式は次に厳密に従え：
+  - 日本の場合：都道府県名のみ（例：愛知、東京）
+  - 米国の場合：市名, 州略称（例：San Francisco, CA）
+  - その他の場合：国名のみ（例：Germany）
+
+出力は「必ず」JSONのみ（前後に説明文を付けない）で返せ。
+JSONスキーマ:
+{{
+  "overview": "150文字以下の日本語で、企業の事業内容を一文で要約せよ。",
+  "hq": "上記のHQ出力形式に従う本社所在地。確証がなければ「不明」。",
+  "description": "日本語で詳細要約せよ。文体は必ず『だ・である』調とする。形式は以下：
+- 事業概要（必ず2〜4文で記述すること）
+- 主な提供価値/顧客（必ず箇条書きで2〜4個）
+- 技術的コアコンピタンス（独自のアルゴリズム、特許技術、利用しているAI技術〔例：LLM、CV〕など、具体的な技術的優位性に焦点を当てて記述せよ）
+- 出典（以下の表記ルールに従い、最後にまとめて記載せよ）
+"
+}}
+
+### 出典表記ルール
+- 出典は description の最後にまとめて記載すること。
+- 表記形式は以下を厳守せよ。
+  「サイト名＋記事タイトル（年）＋(URL)」
+- 複数ある場合は箇条書きで列挙すること。
+
+注意:
+- 不確かな情報は断定せず「可能性がある」などで表現すること。
+- Website がある場合はまずそれを起点に企業を特定せよ。
+""".strip()
+# Structured Outputs 用スキーマ（strict なので全項目 required / additionalProperties=false）
+_OUTPUT_FORMAT = {
+    "type": "json_schema",
+    "name": "company_profile",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "overview": {"type": "string"},
+            "description": {"type": "string"},
+            "hq": {"type": "string"},
+        },
+        "required": ["overview", "description", "hq"],
+        "additionalProperties": False,
+    },
+}
+# キャッシュキー用。プロンプトを変えると自動的に別キーになる
+PROMPT_VERSION = hashlib.sha256(_PROMPT_TMPL.encode("utf-8")).hexdigest()[:12]
+
+# ---- Cache (DynamoDB, 任意) ----
+# CACHE_TABLE: パーティションキー "h"(S)、TTL属性 "ttl" のテーブル。未設定ならキャッシュ無効。
+CACHE_TABLE = os.environ.get("CACHE_TABLE")
+CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# 並行ページから asyncio.to_thread 経由で同時に使うので、スレッドセーフな client を使う
+# （boto3 の resource はスレッド間で共有できない）
+_ddb = None
+if CACHE_TABLE:
+    import boto3  # Lambda ランタイム同梱。キャッシュ無効時は import コストを払わない
+
+    _ddb = boto3.client("dynamodb")
 
 # ---- Notion ----
 NOTION_API_KEY = os.environ.get("NOTION_API_KEY")
 NOTION_VERSION = os.environ.get("NOTION_VERSION", "2022-06-28")
 
+_NOTION_HEADERS = {
+    "Authorization": f"Bearer {NOTION_API_KEY}",
+    "Notion-Version": NOTION_VERSION,
+    "Content-Type": "application/json",
+}
+
+# warm invocation 間で api.notion.com への TLS 接続を使い回す
+_notion_http = httpx.AsyncClient(
+    base_url="https://api.notion.com/v1",
+    headers=_NOTION_HEADERS,
+    limits=httpx.Limits(
+        max_connections=4,
+        max_keepalive_connections=4,
+        keepalive_expiry=_KEEPALIVE_EXPIRY,
+    ),
+    timeout=20,
+)
+# Notion のレート制限（1インテグレーションあたり平均 3 req/s）に合わせて同時 PATCH 数を絞る
+_notion_sem = asyncio.Semaphore(int(os.environ.get("NOTION_CONCURRENCY", "3")))
+# 429 / 5xx のリトライ回数
+NOTION_MAX_RETRIES = 3
+
 
 def _extract_company_info(notion_page_payload: dict) -> tuple[str | None, str | None]:
     """
@@ -20,33 +154,62 @@ def _extract_company_info(notion_page_payload: dict) -> tuple[str | None, str |
     - Website（url）
     を抜き出す
     """
-    props = (notion_page_payload.get("data") or {}).get("properties") or {}
+    data = notion_page_payload.get("data")
+    props = data.get("properties") if isinstance(data, dict) else None
+    if not isinstance(props, dict):
+        return None, None
 
     # 企業名: title -> title[0].plain_text
-    company_name = None
-    try:
-        title_arr = (props.get("企業名") or {}).get("title") or []
-        if title_arr:
-            company_name = title_arr[0].get("plain_text")
-    except Exception:
-        company_name = None
+    t = props.get("企業名")
+    title_arr = t.get("title") if isinstance(t, dict) else None
+    first = title_arr[0] if isinstance(title_arr, list) and title_arr else None
+    company_name = first.get("plain_text") if isinstance(first, dict) else None
 
     # Website: url
-    website = None
-    try:
-        website = (props.get("Website") or {}).get("url")
-    except Exception:
-        website = None
+    w = props.get("Website")
+    website = w.get("url") if isinstance(w, dict) else None
 
     return company_name, website
 
 
+def _is_grapheme_extend(ch: str) -> bool:
+    """直前の文字と一体で表示される文字（結合文字・ZWJ・異体字セレクタ・肌色修飾など）か"""
+    return (
+        unicodedata.category(ch) in ("Mn", "Mc", "Me")
+        or ch == "\u200d"
+        or "\ufe00" <= ch <= "\ufe0f"
+        or "\U0001f3fb" <= ch <= "\U0001f3ff"
+        or "\U000e0020" <= ch <= "\U000e007f"
+    )
+
+
+def _is_regional_indicator(ch: str) -> bool:
+    return "\U0001f1e6" <= ch <= "\U0001f1ff"
+
+
+def _slice_grapheme(s: str, n: int) -> str:
+    """n 文字以内に切り詰める。結合文字・ZWJ 絵文字・国旗の途中では切らない"""
+    if len(s) <= n:
+        return s
+    i = n
+    while i > 0 and (_is_grapheme_extend(s[i]) or s[i - 1] == "\u200d"):
+        i -= 1
+    # 国旗は RI 2文字で1つ。切れ目の直前までの RI の連続数が奇数なら組の途中
+    if i > 0 and _is_regional_indicator(s[i]) and _is_regional_indicator(s[i - 1]):
+        j = i
+        while j > 0 and _is_regional_indicator(s[j - 1]):
+            j -= 1
+        if (i - j) % 2:
+            i -= 1
+    return s[:i]
+
+
 def _truncate_jp_150(text: str) -> str:
     """ざっくり「150文字以下」を担保（Unicodeの文字数ベース）"""
     text = (text or "").strip()
     if len(text) <= 150:
         return text
-    return text[:150].rstrip() + "…"
+    return _slice_grapheme(text, 150).rstrip() + "…"
 
 
 def _clean_hq(text: str) -> str:
@@ -58,13 +221,13 @@ def _clean_hq(text: str) -> str:
     if not t:
         return "不明"
     if len(t) > 60:
-        t = t[:60].rstrip() + "…"
+        t = _slice_grapheme(t, 60).rstrip() + "…"
     if t in ["不詳", "不明。", "不明です", "Unknown", "N/A", "NA", "-"]:
         return "不明"
     return t
 
 
-def _notion_update_overview_description_hq(page_id: str, overview: str, description: str, hq: str) -> None:
+async def _notion_update_overview_description_hq(page_id: str, overview: str, description: str, hq: str) -> None:
     if not NOTION_API_KEY:
         raise RuntimeError("NOTION_API_KEY is not set")
 
@@ -72,11 +235,10 @@ def _notion_update_overview_description_hq(page_id: str, overview: str, descript
 
     description = (description or "").strip()
     if len(description) > 1800:
-        description = description[:1800] + "…"
+        description = _slice_grapheme(description, 1800) + "…"
 
     hq = _clean_hq(hq)
 
-    url = f"https://api.notion.com/v1/pages/{page_id}"
     payload = {
         "properties": {
             "Overview": {
@@ -91,145 +253,285 @@ def _notion_update_overview_description_hq(page_id: str, overview: str, descript
         }
     }
 
-    req = urllib.request.Request(
-        url=url,
-        data=json.dumps(payload).encode("utf-8"),
-        method="PATCH",
-        headers={
-            "Authorization": f"Bearer {NOTION_API_KEY}",
-            "Notion-Version": NOTION_VERSION,
-            "Content-Type": "application/json",
-        },
-    )
+    content = _json_dumps(payload)
+    async with _notion_sem:
+        for attempt in range(NOTION_MAX_RETRIES + 1):
+            resp = await _notion_http.patch(f"/pages/{page_id}", content=content)
+            retryable = resp.status_code == 429 or resp.status_code >= 500
+            if not retryable or attempt == NOTION_MAX_RETRIES:
+                break
+            # Retry-After（秒）があれば従い、無ければ指数バックオフ
+            try:
+                wait = float(resp.headers.get("Retry-After") or 2 ** attempt)
+            except ValueError:
+                wait = 2 ** attempt
+            print(f"[{page_id}]", "Notion retry:", resp.status_code, "wait", wait)
+            await asyncio.sleep(wait)
+
+    if resp.is_error:
+        print(f"[{page_id}]", "Notion HTTPError:", resp.status_code)
+        print(f"[{page_id}]", "Notion HTTPError body:", resp.text)
+        resp.raise_for_status()
+    print(f"[{page_id}]", "Notion update status:", resp.status_code)
+
+
+_json_decoder = json.JSONDecoder()
+
+
+def _extract_json(raw: str) -> dict | None:
+    """raw 中の最初に decode できる JSON オブジェクトを返す。無ければ None"""
+    i = raw.find("{")
+    while i != -1:
+        try:
+            obj, _ = _json_decoder.raw_decode(raw, i)
+            return obj
+        except json.JSONDecodeError:
+            i = raw.find("{", i + 1)
+    return None
+
+
+async def _call_openai(prompt: str) -> str:
+    """OpenAI を呼び、出力テキストを返す。completed 以外（failed / incomplete）は例外を投げる"""
+    async with _oai_sem:
+        response = await client.responses.create(
+            model=MODEL,
+            tools=[{"type": "web_search"}],
+            input=prompt,
+            text={"format": _OUTPUT_FORMAT},
+        )
 
-    try:
-        with urllib.request.urlopen(req, timeout=20) as resp:
-            _ = resp.read().decode("utf-8", errors="replace")
-            print("Notion update status:", resp.status)
-    except urllib.error.HTTPError as e:
-        body = e.read().decode("utf-8", errors="replace")
-        print("Notion HTTPError:", e.code)
-        print("Notion HTTPError body:", body)
-        raise
+    if response.status != "completed":
+        if response.incomplete_details is not None:
+            detail = response.incomplete_details.reason
+        elif response.error is not None:
+            detail = response.error.message
+        else:
+            detail = None
+        raise RuntimeError(f"OpenAI response not completed ({response.status}): {detail}")
+    return (response.output_text or "").strip()
 
 
-def lambda_handler(event, context):
-    # HTTP API (payload v2.0) の想定
-    body_raw = event.get("body") or ""
-    if event.get("isBase64Encoded"):
-        import base64
-        body_raw = base64.b64decode(body_raw).decode("utf-8")
+def _cache_key(company_name: str | None, website: str | None) -> str:
+    return hashlib.sha256(
+        f"{MODEL}|{company_name}|{website}|{PROMPT_VERSION}".encode("utf-8")
+    ).hexdigest()
 
-    try:
-        data = json.loads(body_raw) if body_raw else {}
-    except json.JSONDecodeError:
-        data = {"_raw": body_raw}
 
+async def _cache_get(page_id: str, key: str) -> str | None:
+    """キャッシュ済みの OpenAI 出力を返す。無効・ミス・失敗時は None"""
+    if _ddb is None:
+        return None
     try:
-        # Notion page_id
-        page_id = (data.get("data") or {}).get("id")
-        if not page_id:
-            raise RuntimeError("page_id not found in event body at data.id")
-
-        company_name, website = _extract_company_info(data)
-        if not company_name and not website:
-            raise RuntimeError("company info not found (企業名 / Website)")
-
-        print("page_id:", page_id)
-        print("company_name:", company_name)
-        print("website:", website)
+        resp = await asyncio.to_thread(
+            _ddb.get_item, TableName=CACHE_TABLE, Key={"h": {"S": key}}
+        )
+    except Exception as e:
+        print(f"[{page_id}]", "WARNING: cache get failed:", str(e))
+        return None
+    item = resp.get("Item")
+    # DynamoDB の TTL 削除は遅延するので期限切れは自前で弾く
+    if not item or int(item.get("ttl", {}).get("N") or 0) < time.time():
+        return None
+    return item.get("raw", {}).get("S")
+
+
+async def _cache_put(page_id: str, key: str, raw: str) -> None:
+    if _ddb is None or not raw:
+        return
+    try:
+        await asyncio.to_thread(
+            _ddb.put_item,
+            TableName=CACHE_TABLE,
+            Item={
+                "h": {"S": key},
+                "raw": {"S": raw},
+                "ttl": {"N": str(int(time.time()) + CACHE_TTL_SECONDS)},
+            },
+        )
+    except Exception as e:
+        print(f"[{page_id}]", "WARNING: cache put failed:", str(e))
 
-        # ---- OpenAI web search + summarize (overview/description/HQ を一括生成) ----
-        prompt = f"""
-あなたは企業調査アナリストである。最新のWeb情報を検索して、次の企業の事業内容と本社所在地（HQ）を特定し要約せよ。
 
-- 企業名: {company_name or "(不明)"}
-- Website: {website or "(不明)"}
+class InvalidPayloadError(ValueError):
+    """webhook payload 自体が不正（再試行しても成功しない）"""
 
-### 調査情報源の指示（最重要）
-1. 一次情報としてのホームページ（URL）の情報を核とする。
-2. それに加え、客観的かつ広範な情報を収集するため、少なくとも５つ以上の信頼できる外部情報源
-   （TechCrunch, Bloomberg, Crunchbase, 公式プレスリリース等）を調査し、情報を統合する。
-3. 情報鮮度を重視し、直近3年以内の情報を優先して利用すること。
-4. 特に、技術的な特徴や市場での評価については、第三者による客観的な見解を優先して分析に含めること。
 
-### HQ（本社所在地）の指示（重要）
-- 複数のサイトを調査して本社所在地を特定せよ（一次情報＋第三者情報を照合すること）。
-- 本社所在地が一つに絞ることができない／情報が矛盾する／確証が持てない場合は「不明」と出力せよ。
-- HQの出力形式は次に厳密に従え：
-  - 日本の場合：都道府県名のみ（例：愛知、東京）
-  - 米国の場合：市名, 州略称（例：San Francisco, CA）
-  - その他の場合：国名のみ（例：Germany）
+def _page_id(data) -> str | None:
+    """webhook payload の data.id（Notion page_id）"""
+    d = data.get("data") if isinstance(data, dict) else None
+    return d.get("id") if isinstance(d, dict) else None
 
-出力は「必ず」JSONのみ（前後に説明文を付けない）で返せ。
-JSONスキーマ:
-{{
-  "overview": "150文字以下の日本語で、企業の事業内容を一文で要約せよ。",
-  "hq": "上記のHQ出力形式に従う本社所在地。確証がなければ「不明」。",
-  "description": "日本語で詳細要約せよ。文体は必ず『だ・である』調とする。形式は以下：
-- 事業概要（必ず2〜4文で記述すること）
-- 主な提供価値/顧客（必ず箇条書きで2〜4個）
-- 技術的コアコンピタンス（独自のアルゴリズム、特許技術、利用しているAI技術〔例：LLM、CV〕など、具体的な技術的優位性に焦点を当てて記述せよ）
-- 出典（以下の表記ルールに従い、最後にまとめて記載せよ）
-"
-}}
 
-### 出典表記ルール
-- 出典は description の最後にまとめて記載すること。
-- 表記形式は以下を厳守せよ。
-  「サイト名＋記事タイトル（年）＋(URL)」
-- 複数ある場合は箇条書きで列挙すること。
+async def _process_page(data: dict, force: bool = False) -> None:
+    """1ページ分: OpenAI で調査・要約し、Notion の3カラムを更新する"""
+    # Notion page_id
+    page_id = _page_id(data)
+    if not page_id:
+        raise InvalidPayloadError("page_id not found in event body at data.id")
 
-注意:
-- 不確かな情報は断定せず「可能性がある」などで表現すること。
-- Website がある場合はまずそれを起点に企業を特定せよ。
-""".strip()
+    company_name, website = _extract_company_info(data)
+    if not company_name and not website:
+        raise InvalidPayloadError("company info not found (企業名 / Website)")
 
-        print("calling OpenAI (web_search)...")
-        response = client.responses.create(
-            model="gpt-5-nano",
-            tools=[{"type": "web_search"}],
-            input=prompt,
-        )
+    # 並行処理でログが混ざるので各行に page_id を付ける
+    print(f"[{page_id}]", "company_name:", company_name)
+    print(f"[{page_id}]", "website:", website)
 
-        raw = (response.output_text or "").strip()
-        print("OpenAI done. raw length:", len(raw))
+    # ---- OpenAI web search + summarize (overview/description/HQ を一括生成) ----
+    prompt = _PROMPT_TMPL.format(
+        company_name=company_name or "(不明)",
+        website=website or "(不明)",
+    )
 
-        # JSONパース（失敗したらフォールバック）
+    cache_key = _cache_key(company_name, website)
+    raw = None if force else await _cache_get(page_id, cache_key)
+    cache_hit = raw is not None
+    if cache_hit:
+        print(f"[{page_id}]", "cache hit:", cache_key)
+    else:
+        print(f"[{page_id}]", "calling OpenAI (web_search)...")
+        raw = await _call_openai(prompt)
+        print(f"[{page_id}]", "OpenAI done. raw length:", len(raw))
+
+    # JSONパース（通常は Structured Outputs でそのまま読める。
+    # 前後に説明文がある古いキャッシュ等も拾い、それでも失敗したらフォールバック）
+    overview = ""
+    description = ""
+    hq = "不明"
+    try:
+        obj = _json_loads(raw)
+    except json.JSONDecodeError:
+        obj = _extract_json(raw)
+    if isinstance(obj, dict):
+        overview = obj.get("overview") or ""
+        description = obj.get("description") or ""
+        hq = obj.get("hq") or "不明"
+        # 正しくパースできた出力だけキャッシュする（壊れた出力を30日間使い回さない）
+        if not cache_hit and overview and description:
+            await _cache_put(page_id, cache_key, raw)
+    else:
+        print(f"[{page_id}]", "WARNING: OpenAI output was not valid JSON. Falling back.")
         overview = ""
-        description = ""
+        description = raw
         hq = "不明"
-        try:
-            obj = json.loads(raw)
-            overview = obj.get("overview") or ""
-            description = obj.get("description") or ""
-            hq = obj.get("hq") or "不明"
-        except Exception:
-            print("WARNING: OpenAI output was not valid JSON. Falling back.")
-            overview = ""
-            description = raw
-            hq = "不明"
-
-        # 保険：overviewが空ならdescriptionから雑に作る
-        if not overview:
-            overview = _truncate_jp_150(description.replace("\n", " "))
-
-        hq = _clean_hq(hq)
-
-        # ---- Write to Notion (3カラム同時更新) ----
-        _notion_update_overview_description_hq(page_id, overview, description, hq)
-        print("Notion update done")
 
+    # 保険：overviewが空ならdescriptionから雑に作る
+    if not overview:
+        overview = _truncate_jp_150(description.replace("\n", " "))
+
+    hq = _clean_hq(hq)
+
+    # ---- Write to Notion (3カラム同時更新) ----
+    await _notion_update_overview_description_hq(page_id, overview, description, hq)
+    print(f"[{page_id}]", "Notion update done")
+
+
+def _parse_body(body_raw: str, is_base64: bool = False):
+    # isBase64Encoded が誤って立っていても、既に JSON ならデコードしない
+    if is_base64 and not body_raw.lstrip().startswith(("{", "[")):
+        body_raw = base64.b64decode(body_raw).decode("utf-8")
+
+    try:
+        return _json_loads(body_raw) if body_raw else {}
+    except json.JSONDecodeError:
+        return {"_raw": body_raw}
+
+
+async def _process_many(pages: list, force: bool = False) -> list:
+    """複数ページを並行処理する。結果は入力順の例外 or None"""
+    return await asyncio.gather(
+        *[_process_page(p if isinstance(p, dict) else {}, force=force) for p in pages],
+        return_exceptions=True,
+    )
+
+
+async def _ahandle(event) -> dict:
+    # SQS トリガー: 各レコードの body が webhook payload。失敗分だけ再配信させる
+    # （イベントソースマッピングで ReportBatchItemFailures を有効にすること）
+    if "Records" in event:
+        records = event["Records"]
+        pages = [_parse_body(r.get("body") or "") for r in records]
+        results = await _process_many(pages)
+        failures = []
+        for r, page, res in zip(records, pages, results):
+            if isinstance(res, InvalidPayloadError):
+                # 不正な payload は再配信しても直らないので捨てる（DLQ にも送らない）
+                print(f"[{_page_id(page)}]", "Skipped invalid payload:", r.get("messageId"), str(res))
+            elif isinstance(res, BaseException):
+                print(f"[{_page_id(page)}]", "Error:", r.get("messageId"), str(res))
+                failures.append({"itemIdentifier": r.get("messageId")})
+        return {"batchItemFailures": failures}
+
+    # HTTP API (payload v2.0) の想定
+    data = _parse_body(event.get("body") or "", bool(event.get("isBase64Encoded")))
+
+    # ?force=1 でキャッシュを無視して再生成
+    force = (event.get("queryStringParameters") or {}).get("force") == "1"
+
+    # body が配列なら複数ページをまとめて処理する
+    if isinstance(data, list):
+        results = await _process_many(data, force=force)
+        statuses = []
+        for page, res in zip(data, results):
+            if isinstance(res, BaseException):
+                print(f"[{_page_id(page)}]", "Error:", str(res))
+                statuses.append({"ok": False, "error": str(res)})
+            else:
+                statuses.append({"ok": True})
+        ok = all(st["ok"] for st in statuses)
+        return {
+            "statusCode": 200 if ok else 500,
+            "headers": {"content-type": "application/json"},
+            "body": _json_dumps({"ok": ok, "results": statuses}).decode("utf-8")
+        }
+
+    try:
+        await _process_page(data, force=force)
         return {
             "statusCode": 200,
             "headers": {"content-type": "application/json"},
-            "body": json.dumps({"ok": True})
+            "body": _json_dumps({"ok": True}).decode("utf-8")
         }
 
     except Exception as e:
-        print("Error:", str(e))
+        print(f"[{_page_id(data)}]", "Error:", str(e))
         return {
             "statusCode": 500,
             "headers": {"content-type": "application/json"},
-            "body": json.dumps({"ok": False, "error": str(e)})
+            "body": _json_dumps({"ok": False, "error": str(e)}).decode("utf-8")
         }
+
+
+# warm invocation 間で同じイベントループを使い回す（モジュールレベルのクライアントがループに紐づくため）
+_loop = asyncio.new_event_loop()
+
+
+async def _warm_up() -> None:
+    """INIT フェーズで api.openai.com / api.notion.com への接続を張っておく（失敗は無視）"""
+    async def _openai():
+        await client.with_options(timeout=2, max_retries=0).models.list()
+
+    async def _notion():
+        await _notion_http.get("/users/me", timeout=2)
+
+    tasks = [_openai()]
+    if NOTION_API_KEY:
+        tasks.append(_notion())
+    for res in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(res, BaseException):
+            print("WARNING: warm-up failed:", str(res))
+
+
+# INIT がリクエストの外で走る provisioned-concurrency / snap-start のときだけ行う
+# （on-demand のコールドスタートでは INIT がそのままレイテンシに乗るので逆効果）。WARM_UP=0 で無効化。
+# 接続は _KEEPALIVE_EXPIRY 秒アイドルで破棄されるので、効くのは INIT 直後に最初の invocation が
+# 来る場合だけ。SnapStart では INIT 時の接続が restore 後も生きている保証はない
+# （切れていれば初回リクエストで張り直される）
+if os.environ.get("WARM_UP", "1") != "0" and os.environ.get(
+    "AWS_LAMBDA_INITIALIZATION_TYPE"
+) in ("provisioned-concurrency", "snap-start"):
+    _loop.run_until_complete(_warm_up())
+
+
+def lambda_handler(event, context):
+    return _loop.run_until_complete(_ahandle(event))